@@ -6,6 +6,9 @@ import gradio as gr
 from PIL import Image
 
 MODEL_ID = "Qwen/Qwen-Image-Edit-2511"
+# Room left on the GPU for activations at ~1024px when every component is
+# resident at once.
+VRAM_HEADROOM_BYTES = 4 * 10**9
 pipeline = None
 
 
@@ -15,12 +18,44 @@ def load_pipeline():
         return
     from diffusers import QwenImageEditPlusPipeline
 
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
+
     print(f"Loading {MODEL_ID} ...")
     pipeline = QwenImageEditPlusPipeline.from_pretrained(
         MODEL_ID,
         torch_dtype=torch.bfloat16,
     )
-    pipeline.enable_model_cpu_offload()
+    # Offloading always costs PCIe copies per step, so only use it when the
+    # weights don't fit. In bf16 the pipeline is ~58 GB (transformer ~41 GB,
+    # text encoder ~16 GB):
+    #   - 80 GB+ cards (A100-80GB, H100) hold everything -> full GPU.
+    #   - A40 (48 GB) and A100-40GB (~42.5 GB) hold the transformer alone ->
+    #     model offload, as in the baseline. Like the baseline, this tier adds
+    #     no headroom check: the A100-40GB has under 2 GB spare beside the
+    #     transformer, and sequential offload would be far slower.
+    #   - Smaller cards can't hold the transformer -> sequential offload.
+    component_bytes = [
+        sum(t.numel() * t.element_size() for t in (*m.parameters(), *m.buffers()))
+        for m in pipeline.components.values()
+        if isinstance(m, torch.nn.Module)
+    ]
+    vram = torch.cuda.get_device_properties(0).total_memory
+    if sum(component_bytes) + VRAM_HEADROOM_BYTES <= vram:
+        placement = "full GPU"
+        pipeline.to("cuda")
+    elif max(component_bytes) < vram:
+        placement = "model CPU offload"
+        pipeline.enable_model_cpu_offload()
+    else:
+        placement = "sequential CPU offload"
+        pipeline.enable_sequential_cpu_offload()
+    print(
+        f"GPU VRAM: {vram / 1e9:.1f} GB, weights: {sum(component_bytes) / 1e9:.1f} GB "
+        f"-> {placement}"
+    )
     pipeline.set_progress_bar_config(disable=None)
     print("Model loaded and ready.")
 
@@ -48,12 +83,23 @@ def edit_image(
     input_imgs = images if len(images) > 1 else images[0]
 
     generator = torch.manual_seed(int(seed)) if int(seed) >= 0 else None
-
-    with torch.inference_mode():
+    # With CFG off the negative prompt has no effect, so don't encode it.
+    if float(cfg_scale) <= 1.0:
+        negative_prompt = None
+    else:
+        negative_prompt = negative_prompt or " "
+
+    # Keep attention on the fused flash / memory-efficient SDPA kernels.
+    # torch.backends.cuda.sdp_kernel is used because the pod image ships
+    # torch 2.1, which predates torch.nn.attention.sdpa_kernel.
+    sdp_context = torch.backends.cuda.sdp_kernel(
+        enable_flash=True, enable_mem_efficient=True, enable_math=False
+    )
+    with torch.inference_mode(), sdp_context:
         result = pipeline(
             image=input_imgs,
             prompt=prompt,
-            negative_prompt=negative_prompt or " ",
+            negative_prompt=negative_prompt,
             num_inference_steps=int(steps),
             true_cfg_scale=float(cfg_scale),
             guidance_scale=1.0,
@@ -100,7 +146,7 @@ with gr.Blocks(title="Qwen Image Edit 2511", theme=gr.themes.Soft()) as demo:
                 )
             with gr.Row():
                 cfg_scale = gr.Slider(
-                    minimum=1.0, maximum=10.0, value=4.0, step=0.5, label="CFG scale"
+                    minimum=1.0, maximum=10.0, value=4.0, step=0.5, label="CFG scale (1 = off)"
                 )
                 seed = gr.Number(value=-1, label="Seed (-1 = random)")
 
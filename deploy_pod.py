@@ -13,9 +13,14 @@ if not RUNPOD_API_KEY:
     sys.exit(1)
 GRAPHQL_URL = f"https://api.runpod.io/graphql?api_key={RUNPOD_API_KEY}"
 
+# Reuse one keep-alive connection for all API calls. All GraphQL calls
+# (including wait_for_pod's polling) are POSTs, which urllib3 never retries,
+# so no retry adapter is mounted.
+_session = requests.Session()
+
 
 def graphql(query):
-    resp = requests.post(GRAPHQL_URL, json={"query": query})
+    resp = _session.post(GRAPHQL_URL, json={"query": query})
     data = resp.json()
     if "errors" in data:
         print(f"GraphQL errors:\n{json.dumps(data['errors'], indent=2)}")
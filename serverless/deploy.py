@@ -18,6 +18,10 @@ if not RUNPOD_API_KEY:
     sys.exit(1)
 REST_URL = "https://rest.runpod.io/v1"
 
+# Reuse one keep-alive connection for all API calls. Every call here
+# is a POST, which urllib3 never retries, so no retry adapter is mounted.
+_session = requests.Session()
+
 IMAGE_NAME = "ghcr.io/renaldoa/qwen-image-edit-serverless:latest"
 ENDPOINT_NAME = "qwen-image-edit"
 MODEL_NAME = "Qwen/Qwen-Image-Edit-2511"
@@ -29,7 +33,7 @@ def rest_api(method, path, payload=None):
         "Authorization": f"Bearer {RUNPOD_API_KEY}",
         "Content-Type": "application/json",
     }
-    resp = requests.request(method, url, headers=headers, json=payload)
+    resp = _session.request(method, url, headers=headers, json=payload)
     if resp.status_code >= 400:
         print(f"API error ({resp.status_code}):\n{resp.text}")
         sys.exit(1)
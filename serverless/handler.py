@@ -14,9 +14,24 @@ print("=" * 60, flush=True)
 
 import base64
 import io
+from concurrent.futures import ThreadPoolExecutor
 
 print("Importing torch...", flush=True)
 import torch
+import torch.nn.functional as F
+from torch.nn.attention import SDPBackend, sdpa_kernel
+
+# Fixed model and input sizes: let cuDNN autotune conv kernels, and allow
+# TF32 on Ampere+ tensor cores for any fp32 matmuls/convs.
+torch.backends.cudnn.benchmark = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision("high")
+
+# The Qwen transformer's joint-attention processor already calls SDPA; keep it
+# on the fused flash / memory-efficient kernels instead of the math fallback.
+SDPA_BACKENDS = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]
+
 print(f"PyTorch {torch.__version__}, CUDA available: {torch.cuda.is_available()}", flush=True)
 if torch.cuda.is_available():
     print(f"GPU: {torch.cuda.get_device_name(0)}, VRAM: {torch.cuda.get_device_properties(0).total_mem / 1e9:.1f} GB", flush=True)
@@ -28,11 +43,39 @@ print("Importing PIL...", flush=True)
 from PIL import Image
 
 print("Importing diffusers...", flush=True)
-from diffusers import QwenImageEditPlusPipeline
+from diffusers import BitsAndBytesConfig, QwenImageEditPlusPipeline, QwenImageTransformer2DModel
 print("All imports done.", flush=True)
 
 MODEL_ID = "Qwen/Qwen-Image-Edit-2511"
 
+# Set QWEN_COMPILE=0 to skip torch.compile and run the transformer eagerly.
+COMPILE_TRANSFORMER = os.environ.get("QWEN_COMPILE", "1") == "1"
+
+# Compute dtype for the whole pipeline. QWEN_DTYPE=bfloat16|float16 (or
+# bf16|fp16) overrides the default of bf16, or fp16 on pre-Ampere GPUs
+# without bf16 support.
+# fp16 is opt-in: Qwen-Image's text encoder and transformer can overflow in
+# it, and on Ampere/Hopper the two run at the same tensor-core rate.
+_DTYPES = {
+    "bfloat16": torch.bfloat16,
+    "bf16": torch.bfloat16,
+    "float16": torch.float16,
+    "fp16": torch.float16,
+}
+_default_dtype = (
+    "bfloat16" if not torch.cuda.is_available() or torch.cuda.is_bf16_supported() else "float16"
+)
+_dtype_name = os.environ.get("QWEN_DTYPE", _default_dtype).lower()
+if _dtype_name not in _DTYPES:
+    print(f"Unknown QWEN_DTYPE={_dtype_name!r}, using {_default_dtype}", flush=True)
+    _dtype_name = _default_dtype
+DTYPE = _DTYPES[_dtype_name]
+print(f"Using dtype: {DTYPE}", flush=True)
+
+# Weight-only quantization for the transformer: "int8", "nf4", or empty for
+# an unquantized transformer. VAE and text encoder always stay in DTYPE.
+QUANTIZE = os.environ.get("QWEN_QUANTIZE", "").lower()
+
 # RunPod model caching stores HF models at this path.
 CACHE_DIR = "/runpod-volume/huggingface-cache/hub"
 if os.path.isdir(CACHE_DIR):
@@ -42,14 +85,87 @@ else:
     print(f"RunPod cache dir not found ({CACHE_DIR}), using default HF cache", flush=True)
     print(f"HF_HOME={os.environ.get('HF_HOME', 'not set')}", flush=True)
 
+# Token downsampling (ToDo): jobs that pass "tome_ratio" > 0 average-pool the
+# image tokens of every attention's keys/values along the sequence, leaving
+# queries and the text tokens intact. The ratio is the fraction of image K/V
+# tokens removed and must map to an integer pooling stride k, i.e. be 1 - 1/k
+# (0.5 -> 2, 0.75 -> 4, 0.875 -> 8).
+_token_downsample = {"available": False, "stride": 1, "txt_len": 0}
+
+
+def _pool_image_tokens(x, txt_len, stride):
+    """Average-pool the image tokens of a [B, S, H, D] tensor along S."""
+    txt, img = x[:, :txt_len], x[:, txt_len:]
+    b, s, h, d = img.shape
+    img = img.permute(0, 2, 3, 1).reshape(b, h * d, s)
+    img = F.avg_pool1d(img, stride, stride, ceil_mode=True)
+    img = img.reshape(b, h, d, -1).permute(0, 3, 1, 2)
+    return torch.cat([txt, img], dim=1)
+
+
+def _install_token_downsampling(transformer):
+    """Route the transformer's joint attention through the ToDo K/V pooling.
+
+    This patches diffusers internals, so it runs after loading under its own
+    guard rather than at import time; a failure only disables ToDo.
+    """
+    from diffusers.models.transformers import transformer_qwenimage
+
+    dispatch_attention_fn = transformer_qwenimage.dispatch_attention_fn
+
+    def downsampled_attention_fn(query, key, value, attn_mask=None, **kwargs):
+        stride = _token_downsample["stride"]
+        if stride > 1:
+            txt_len = _token_downsample["txt_len"]
+            key = _pool_image_tokens(key, txt_len, stride)
+            value = _pool_image_tokens(value, txt_len, stride)
+            if attn_mask is not None:
+                # Image tokens are never masked, so trimming keeps the mask valid.
+                attn_mask = attn_mask[..., : key.shape[1]]
+        return dispatch_attention_fn(query, key, value, attn_mask=attn_mask, **kwargs)
+
+    class TokenDownsampleAttnProcessor(transformer_qwenimage.QwenDoubleStreamAttnProcessor2_0):
+        """Qwen joint-attention processor that records the text length for ToDo."""
+
+        def __call__(self, attn, hidden_states, encoder_hidden_states=None, *args, **kwargs):
+            # Only ToDo jobs, which run eagerly, write the global; inside the
+            # compiled transformer stride is always 1 and this is dead code.
+            if _token_downsample["stride"] > 1:
+                _token_downsample["txt_len"] = encoder_hidden_states.shape[1]
+            return super().__call__(attn, hidden_states, encoder_hidden_states, *args, **kwargs)
+
+    transformer_qwenimage.dispatch_attention_fn = downsampled_attention_fn
+    transformer.set_attn_processor(TokenDownsampleAttnProcessor())
+
+
 # Load pipeline at module level so it persists between requests
 print(f"Loading {MODEL_ID} ...", flush=True)
 pipeline = None
 _load_error = None
 try:
+    pipeline_kwargs = {}
+    if QUANTIZE in ("int8", "nf4"):
+        print(f"Loading transformer quantized to {QUANTIZE}...", flush=True)
+        if QUANTIZE == "int8":
+            bnb_config = BitsAndBytesConfig(load_in_8bit=True)
+        else:
+            bnb_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=DTYPE,
+            )
+        pipeline_kwargs["transformer"] = QwenImageTransformer2DModel.from_pretrained(
+            MODEL_ID,
+            subfolder="transformer",
+            quantization_config=bnb_config,
+            torch_dtype=DTYPE,
+        )
+    elif QUANTIZE:
+        print(f"Unknown QWEN_QUANTIZE={QUANTIZE!r}, loading unquantized", flush=True)
     pipeline = QwenImageEditPlusPipeline.from_pretrained(
         MODEL_ID,
-        torch_dtype=torch.bfloat16,
+        torch_dtype=DTYPE,
+        **pipeline_kwargs,
     )
     print("Pipeline loaded, moving to CUDA...", flush=True)
     pipeline.to("cuda")
@@ -62,17 +178,132 @@ except Exception as e:
     traceback.print_exc()
     print("Will start serverless loop anyway to report errors via API.", flush=True)
 
+def _vae_to_channels_last(vae):
+    """Put the VAE's conv weights in NHWC-style layouts for cuDNN.
+
+    The VAE mixes 3D causal convs with 2D convs in its resample and attention
+    blocks, so each kind gets its own format rather than a blanket vae.to().
+    """
+    for module in vae.modules():
+        if isinstance(module, torch.nn.Conv3d):
+            module.weight.data = module.weight.to(memory_format=torch.channels_last_3d)
+        elif isinstance(module, torch.nn.Conv2d):
+            module.weight.data = module.weight.to(memory_format=torch.channels_last)
+
+
+# Optional tweaks applied after loading; a failure here only skips the tweak.
+if pipeline is not None:
+    try:
+        _vae_to_channels_last(pipeline.vae)
+    except Exception as e:
+        print(f"WARNING: Could not convert VAE to channels-last: {e}", flush=True)
+    try:
+        _install_token_downsampling(pipeline.transformer)
+        _token_downsample["available"] = True
+    except Exception as e:
+        print(f"WARNING: Token downsampling unavailable: {e}", flush=True)
+
+
+def _warmup():
+    """Run a throwaway 2-step edit at cold start.
+
+    This moves Inductor compilation and cuDNN autotuning off the first job.
+    CUDA graphs are only captured for the warmup's own shapes: each new
+    prompt length still costs one warm-up run and one record run per shape.
+    """
+    with torch.inference_mode(), sdpa_kernel(SDPA_BACKENDS):
+        pipeline(
+            image=Image.new("RGB", (1024, 1024)),
+            prompt="warmup",
+            negative_prompt=" ",
+            num_inference_steps=2,
+            true_cfg_scale=4.0,
+            guidance_scale=1.0,
+        )
+    torch.cuda.synchronize()
+
+
+def _cudagraph_step_begin(module, args):
+    torch.compiler.cudagraph_mark_step_begin()
+
+
+def _clone_cudagraph_outputs(module, args, output):
+    # CUDA-graph outputs live in a static pool that the next replay reuses,
+    # but with true CFG the pipeline still reads the cond prediction after the
+    # uncond call. The pipeline always calls with return_dict=False.
+    if isinstance(output, tuple):
+        return tuple(o.clone() if isinstance(o, torch.Tensor) else o for o in output)
+    return output
+
+
+# Compile the transformer so the per-step kernels are fused and replayed as
+# CUDA graphs. Each call starts a new cudagraph step and copies its outputs
+# out of the graph pool. Compilation is lazy, so the warmup call is what
+# actually triggers it; any failure there drops back to the eager module.
+# Graphs are recorded per concrete text length (prompt plus image tokens), so
+# the first job at each new length still records its own graphs.
+_warmed_up = False
+if pipeline is not None and COMPILE_TRANSFORMER:
+    eager_transformer = pipeline.transformer
+    try:
+        print("Compiling transformer (reduce-overhead)...", flush=True)
+        compiled_transformer = torch.compile(
+            eager_transformer, mode="reduce-overhead", fullgraph=False
+        )
+        compiled_transformer.register_forward_pre_hook(_cudagraph_step_begin)
+        compiled_transformer.register_forward_hook(_clone_cudagraph_outputs)
+        pipeline.transformer = compiled_transformer
+        _warmup()
+        _warmed_up = True
+        print("Transformer compiled and warmed up.", flush=True)
+    except Exception as e:
+        print(f"WARNING: torch.compile failed, using eager transformer: {e}", flush=True)
+        torch._dynamo.reset()
+        pipeline.transformer = eager_transformer
+
+# The eager path still benefits from a warmup (cuDNN autotuning for the VAE,
+# allocator growth). A failure here is not fatal; jobs will just start cold.
+if pipeline is not None and not _warmed_up:
+    try:
+        print("Warming up pipeline...", flush=True)
+        _warmup()
+        print("Pipeline warmed up.", flush=True)
+    except Exception as e:
+        print(f"WARNING: Warmup failed: {e}", flush=True)
+
+
+# PIL codecs and base64 release the GIL, so multi-image jobs decode and
+# encode their images concurrently.
+_io_pool = ThreadPoolExecutor(max_workers=4)
+
+
+# The pipeline resizes inputs to roughly this many pixels per side for the
+# VAE, so JPEGs can be decoded at a reduced DCT scale down to this size.
+DECODE_DRAFT_SIZE = (1024, 1024)
+
 
 def decode_image(b64_string):
-    """Decode a base64 string to a PIL Image."""
+    """Decode a base64 string to an RGB PIL Image."""
     image_bytes = base64.b64decode(b64_string)
-    return Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    img = Image.open(io.BytesIO(image_bytes))
+    img.draft("RGB", DECODE_DRAFT_SIZE)
+    img.load()
+    return img if img.mode == "RGB" else img.convert("RGB")
+
+
+# PIL save arguments per output format. PNG is lossless but slow to encode
+# and several times larger; JPEG/WebP at q92 are visually lossless for edits.
+OUTPUT_FORMATS = {
+    "jpeg": {"format": "JPEG", "quality": 92, "subsampling": 0},
+    "webp": {"format": "WEBP", "quality": 92, "method": 4},
+    "png": {"format": "PNG"},
+}
 
 
-def encode_image(pil_image):
-    """Encode a PIL Image to a base64 PNG string."""
+def encode_image(pil_image, output_format="jpeg"):
+    """Encode a PIL Image to a base64 string in the given output format."""
     buf = io.BytesIO()
-    pil_image.save(buf, format="PNG")
+    pil_image.save(buf, **OUTPUT_FORMATS[output_format])
     return base64.b64encode(buf.getvalue()).decode("utf-8")
 
 
@@ -88,7 +319,7 @@ def handler(job):
         raw_images = job_input["images"]
         if not isinstance(raw_images, list) or len(raw_images) == 0:
             return {"error": "'images' must be a non-empty list of base64 strings."}
-        images = [decode_image(b) for b in raw_images]
+        images = list(_io_pool.map(decode_image, raw_images))
         multi_input = True
     elif "image" in job_input:
         images = [decode_image(job_input["image"])]
@@ -101,30 +332,63 @@ def handler(job):
     if not prompt:
         return {"error": "'prompt' is required."}
 
+    # Not cached across jobs: Qwen2.5-VL encodes the negative prompt together
+    # with this job's input images, so its embeddings differ per request.
     negative_prompt = job_input.get("negative_prompt", " ")
     num_inference_steps = int(job_input.get("num_inference_steps", 40))
     true_cfg_scale = float(job_input.get("true_cfg_scale", 4.0))
+    if true_cfg_scale <= 1.0:
+        # No true CFG: the negative prompt would have no effect on the result.
+        negative_prompt = None
     seed = int(job_input.get("seed", -1))
     num_images_per_prompt = int(job_input.get("num_images_per_prompt", 1))
+    tome_ratio = float(job_input.get("tome_ratio", 0.0))
+    tome_stride = 1 / (1 - tome_ratio) if 0.0 <= tome_ratio < 1.0 else 0
+    if tome_stride < 1 or abs(tome_stride - round(tome_stride)) > 0.01:
+        return {"error": "'tome_ratio' must be 0 or 1 - 1/k for an integer k >= 2 (0.5, 0.75, ...)."}
+    if tome_stride > 1 and not _token_downsample["available"]:
+        return {"error": "'tome_ratio' is not supported by this worker's diffusers version."}
+    output_format = str(job_input.get("output_format", "jpeg")).lower()
+    if output_format == "jpg":
+        output_format = "jpeg"
+    if output_format not in OUTPUT_FORMATS:
+        return {"error": f"'output_format' must be one of: {', '.join(OUTPUT_FORMATS)}."}
 
-    generator = torch.manual_seed(seed) if seed >= 0 else None
+    # A CUDA generator samples the initial noise on-device and leaves the
+    # global CPU RNG untouched.
+    generator = torch.Generator(device="cuda").manual_seed(seed) if seed >= 0 else None
+    # Inputs stay as PIL images: the pipeline resizes each one twice on the
+    # CPU (for the vision-language encoder and for the VAE), so there is no
+    # fixed-size tensor to upload to the GPU ahead of the call.
     input_imgs = images if len(images) > 1 else images[0]
 
     # --- Run inference ---
-    with torch.inference_mode():
-        result = pipeline(
-            image=input_imgs,
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            num_inference_steps=num_inference_steps,
-            true_cfg_scale=true_cfg_scale,
-            guidance_scale=1.0,
-            generator=generator,
-            num_images_per_prompt=num_images_per_prompt,
-        )
+    # ToDo jobs bypass the compiled transformer: the stride is a Python value
+    # that Dynamo guards on, so each new stride would recompile and re-record
+    # the whole transformer on the request path.
+    transformer = pipeline.transformer
+    if tome_stride > 1 and hasattr(transformer, "_orig_mod"):
+        pipeline.transformer = transformer._orig_mod
+    _token_downsample["stride"] = round(tome_stride)
+    try:
+        with torch.inference_mode(), sdpa_kernel(SDPA_BACKENDS):
+            result = pipeline(
+                image=input_imgs,
+                prompt=prompt,
+                negative_prompt=negative_prompt,
+                num_inference_steps=num_inference_steps,
+                true_cfg_scale=true_cfg_scale,
+                guidance_scale=1.0,
+                generator=generator,
+                num_images_per_prompt=num_images_per_prompt,
+            )
+    finally:
+        _token_downsample["stride"] = 1
+        pipeline.transformer = transformer
 
     # --- Encode output ---
-    encoded = [encode_image(img) for img in result.images]
+    formats = [output_format] * len(result.images)
+    encoded = list(_io_pool.map(encode_image, result.images, formats))
 
     if num_images_per_prompt == 1 and not multi_input:
         return {"image": encoded[0]}
@@ -4,66 +4,99 @@
 import argparse
 import base64
 import json
+import mmap
 import os
 import sys
 import time
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # faster parsing of result payloads with base64 images
+except ImportError:
+    orjson = None
 
 RUNPOD_API_KEY = os.environ.get("RUNPOD_API_KEY")
 if not RUNPOD_API_KEY:
     print("Set RUNPOD_API_KEY environment variable.")
     sys.exit(1)
+API_URL = "https://api.runpod.ai/v2"
+
+# How long the status endpoint may hold a request open waiting for the job.
+STATUS_WAIT_MS = 30000
+
+# One keep-alive session so polling doesn't redo the TLS handshake each time;
+# idempotent requests (status polls) are retried on connection errors.
+_session = requests.Session()
+_session.mount(
+    "https://",
+    HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=Retry(total=3, backoff_factor=0.5)),
+)
+_session.headers.update({"Authorization": f"Bearer {RUNPOD_API_KEY}"})
 
 
 def load_image_b64(path):
     with open(path, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+        # mmap can't map a 0-byte file; read it instead so the worker reports
+        # the bad image rather than the client crashing.
+        if os.fstat(f.fileno()).st_size == 0:
+            return base64.b64encode(f.read()).decode("utf-8")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return base64.b64encode(mm).decode("utf-8")
 
 
-def submit_job(endpoint_id, payload):
-    url = f"https://api.runpod.ai/v2/{endpoint_id}/run"
-    headers = {
-        "Authorization": f"Bearer {RUNPOD_API_KEY}",
-        "Content-Type": "application/json",
-    }
-    resp = requests.post(url, headers=headers, json=payload)
+def _parse(resp):
+    """Decode a JSON response, with orjson when available (results carry base64 images)."""
+    return orjson.loads(resp.content) if orjson else resp.json()
+
+
+def submit_job(endpoint_id, payload, sync=True):
+    """Submit a job via /runsync (waits for the result) or /run (returns an ID)."""
+    url = f"{API_URL}/{endpoint_id}/{'runsync' if sync else 'run'}"
+    resp = _session.post(url, json=payload)
     resp.raise_for_status()
-    return resp.json()
+    return _parse(resp)
+
+
+def check_failed(data):
+    if data.get("status") == "FAILED":
+        print(" FAILED")
+        print(json.dumps(data, indent=2))
+        sys.exit(1)
 
 
 def poll_status(endpoint_id, job_id, timeout=600):
-    url = f"https://api.runpod.ai/v2/{endpoint_id}/status/{job_id}"
-    headers = {"Authorization": f"Bearer {RUNPOD_API_KEY}"}
+    url = f"{API_URL}/{endpoint_id}/status/{job_id}"
     start = time.time()
     print("Waiting for result", end="", flush=True)
     while time.time() - start < timeout:
-        resp = requests.get(url, headers=headers)
-        data = resp.json()
-        status = data.get("status")
-        if status == "COMPLETED":
+        request_start = time.time()
+        resp = _session.get(url, params={"wait": STATUS_WAIT_MS})
+        data = _parse(resp)
+        if data.get("status") == "COMPLETED":
             print(" done!")
             return data["output"]
-        if status == "FAILED":
-            print(" FAILED")
-            print(json.dumps(data, indent=2))
-            sys.exit(1)
+        check_failed(data)
         print(".", end="", flush=True)
-        time.sleep(3)
+        # Back off if the server answered immediately instead of long-polling.
+        if time.time() - request_start < 1:
+            time.sleep(1)
     print("\nTimed out.")
     sys.exit(1)
 
 
-def save_result(output, output_dir):
+def save_result(output, output_dir, ext="png"):
     os.makedirs(output_dir, exist_ok=True)
     if "image" in output:
-        path = os.path.join(output_dir, "result.png")
+        path = os.path.join(output_dir, f"result.{ext}")
         with open(path, "wb") as f:
             f.write(base64.b64decode(output["image"]))
         print(f"Saved: {path}")
     elif "images" in output:
         for i, b64 in enumerate(output["images"]):
-            path = os.path.join(output_dir, f"result_{i}.png")
+            path = os.path.join(output_dir, f"result_{i}.{ext}")
             with open(path, "wb") as f:
                 f.write(base64.b64decode(b64))
             print(f"Saved: {path}")
@@ -82,6 +115,15 @@ def main():
     parser.add_argument("--cfg-scale", type=float, default=4.0, help="True CFG scale")
     parser.add_argument("--seed", type=int, default=-1, help="Seed (-1 = random)")
     parser.add_argument("--num-images", type=int, default=1, help="Number of images to generate")
+    parser.add_argument(
+        "--async",
+        dest="sync",
+        action="store_false",
+        help="Submit via /run and poll, for jobs that may exceed the /runsync window",
+    )
+    parser.add_argument(
+        "--output-format", default="jpeg", choices=["jpeg", "webp", "png"], help="Result image format"
+    )
     args = parser.parse_args()
 
     print(f"Loading image: {args.image}")
@@ -96,16 +138,23 @@ def main():
             "true_cfg_scale": args.cfg_scale,
             "seed": args.seed,
             "num_images_per_prompt": args.num_images,
+            "output_format": args.output_format,
         }
     }
 
     print(f"\nSubmitting job to endpoint {args.endpoint_id} ...")
-    result = submit_job(args.endpoint_id, payload)
+    result = submit_job(args.endpoint_id, payload, sync=args.sync)
     job_id = result["id"]
     print(f"Job ID: {job_id}")
 
-    output = poll_status(args.endpoint_id, job_id)
-    save_result(output, args.output_dir)
+    check_failed(result)
+    if result.get("status") == "COMPLETED":
+        output = result["output"]
+    else:
+        # /run, or /runsync that hit its wait limit before the job finished.
+        output = poll_status(args.endpoint_id, job_id)
+    ext = "jpg" if args.output_format == "jpeg" else args.output_format
+    save_result(output, args.output_dir, ext)
     print("\nDone!")
 
 